@@ -18,11 +18,55 @@ CLASSES:
 """
 
 import requests  # to get file from web
-import tempfile  # to create a temporary file to store downloaded data temporarily
-import gzip  # to unzip the file
+import urllib3  # to catch network errors while reading response stream
+try:
+    from isal import igzip as gzip  # to unzip the file, faster than gzip if installed
+    from isal.isal_zlib import error as DecompressionError  # to catch errors of corrupt .gz file
+except ImportError:
+    import gzip  # to unzip the file
+    from zlib import error as DecompressionError  # to catch errors of corrupt .gz file
+import io  # to buffer reads from downloaded file
+import heapq  # to find top k packages in a single pass
+from array import array  # to store number of files associated as a compact array of ints
+from collections import Counter, deque  # to count number of files associated with each package
+from itertools import chain  # to count package names of all lines in one go
+from concurrent.futures import ProcessPoolExecutor  # to count packages using all cpu cores
+from concurrent.futures.process import BrokenProcessPool  # to catch failure of a worker process
+import os  # to find number of usable cpu cores and cache directory
+import hashlib  # to name cache files
+import pickle  # to store processed Contents file in cache
 from sys import argv, exit  # to take command line arguments and exit if error occurs
 
 
+# size of reads from the http response, gzip reads it in much smaller pieces otherwise.
+_READ_BUFFER_SIZE = 128*1024
+
+# size of unzipped data counted at a time, by a worker process if there is more than one cpu core.
+_BLOCK_SIZE = 1024*1024
+
+# smallest k for which numpy partition is used to find top k packages, if numpy is installed.
+# below it heapq takes less time than importing numpy (about 50 ms).
+_NUMPY_TOP_K = 20000
+
+# processed Contents files are kept here, keyed by url.
+_CACHE_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+    "~/.cache"), "package_statistics")
+
+
+def _count_packages(block):
+    """
+    create a dict, key=package name ,value= no of files associated,for a block of complete lines of Contents file.
+
+    paremeters:
+        block -> bytes: lines of Contents file.
+    """
+
+    # tranformation :   b"filename    pack1,pack2\nfilename pack3\n" =>  b"pack1",b"pack2",b"pack3"
+    lines = (line.rstrip() for line in block.split(b"\n"))
+    return Counter(chain.from_iterable(
+        line.rpartition(b" ")[2].split(b",") for line in lines if line))
+
+
 class PackageStatistics:
     '''
     the objects of this class can find top k packages in a .deb repository with most number of files
@@ -38,14 +82,29 @@ class PackageStatistics:
             __file_url: url of Contents index file.
             __top_k : number of packages to be printed as output. 
             __file : object to store and tranform data.
+            __names : package names, indexed by package id.
+            __counts : number of files associated, indexed by package id.
+            __response : http response the Contents file is streamed from.
+            __version : ETag and Last-Modified headers of Contents file on server.
+            __cache_file : path of cached __version,__names and __counts for this url.
+            __cache : (__version,__names,__counts) from previous run, or None.
 
         private methods:
 
+            __load_cache()
+                load __version,__names and __counts of Contents file from previous run.
+
             __get_file():
-                get the Contents index file from web
+                get the Contents index file from web, unless it has not changed since previous run.
+
+            __read_blocks()
+                yield unzipped Contents file in blocks of complete lines.
 
             __process_file()
-                convert Contents file into dict with key=package name,value=number of files associated.
+                convert Contents file into package names and number of files associated with each of them.
+
+            __save_cache()
+                store __version,__names and __counts for next run.
 
             __find()
                 find __top_k packages with highest number of files associated.
@@ -70,85 +129,170 @@ class PackageStatistics:
         """print output"""
 
         # private methods to be called in this order only.
+        self.__load_cache()
         self.__get_file()
-        self.__process_file()
+
+        # process the file only if it has changed since it was last processed
+        if self.__file is not None:
+            self.__process_file()
+            self.__save_cache()
+
         self.__find_packages()
         self.__print()
 
     def __get_file(self):
         """ get the Contents index file of the repository. """
 
+        # ask server to send the file only if it has changed since it was cached
+        headers = {}
+        if self.__cache is not None:
+            cached_version = self.__cache[0]
+            if "ETag" in cached_version:
+                headers["If-None-Match"] = cached_version["ETag"]
+            if "Last-Modified" in cached_version:
+                headers["If-Modified-Since"] = cached_version["Last-Modified"]
+
         try:
-            # create a temporary file to store data to be downloaded from web.
-            temporary_file = tempfile.NamedTemporaryFile()
-        except:
-            print(
-                "[ERROR] unable to create a temporary file to store data to be downloaded!")
-            # try again error
-            exit(11)
-        try:
-            # get file from web
-            contents_file = requests.get(self.__file_url)
-            if contents_file.status_code != 200:  # 200 means OK / success
-                print(contents_file.status_code)
-                raise Exception()
-            contents_file = contents_file.content
-        except:
-            print("[ERROR] unable to get Content file from web!")
+            # get file from web as a stream, it is unzipped and processed while being downloaded
+            response = requests.get(
+                self.__file_url, headers=headers, stream=True)
+
+            # version of the file on server, without it there is no way to know if cache is stale
+            self.__version = {header: response.headers[header] for header in (
+                "ETag", "Last-Modified") if header in response.headers}
+
+            # 304 means not modified, some servers send whole file with same version instead
+            if self.__cache is not None and (response.status_code == 304 or (
+                    response.status_code == 200 and self.__version and self.__version == self.__cache[0])):
+                response.close()
+                _, self.__names, self.__counts = self.__cache
+                self.__file = None
+                return
+
+            if response.status_code != 200:  # 200 means OK / success
+                raise requests.HTTPError(
+                    f"status code {response.status_code}", response=response)
+
+            # keep the body gzipped, even if server sets Content-Encoding header
+            response.raw.decode_content = False
+
+            # keep the stream readable at end of body, so buffered readers can detect EOF
+            response.raw.auto_close = False
+        except requests.RequestException as error:
+            print(f"[ERROR] unable to get Content file from web! ({error})")
             exit(11)
-        try:
-            # store downloaded content file in a local temporary file
-            temporary_file.write(contents_file)
 
-            # to free up space as file is stored in temporary_file
-            del contents_file
-        except:
-            print("[ERROR] unable to write to local temporary file!")
-            exit(11)
+        # unzip file as a stream of raw bytes, it is read chunk by chunk during processing
+        # instead of keeping whole downloaded or unzipped file in memory.
+        self.__response = response
+        # GzipFile buffers unzipped data itself, only the compressed input needs a bigger buffer.
+        self.__file = gzip.GzipFile(fileobj=io.BufferedReader(
+            response.raw, buffer_size=_READ_BUFFER_SIZE), mode="rb")
+
+    def __read_blocks(self):
+        """yield unzipped Contents file in blocks of about _BLOCK_SIZE bytes of complete lines."""
+
+        residual = b""  # incomplete last line of previous chunk
+        for chunk in iter(lambda: self.__file.read(_BLOCK_SIZE), b""):
+            # cut chunk after its last complete line, rest is carried over to next chunk
+            end = chunk.rfind(b"\n")+1
+            if end == 0:
+                residual += chunk
+                continue
+            yield residual+chunk[:end]
+            residual = chunk[end:]
+
+        # last line of file may not end with a newline
+        if residual:
+            yield residual
+
+    def __process_file(self):
+        """create a dict, key=package name ,value= no of files associated"""
+
+        # build a dict of packages and number of files associated,
+        # blocks of about 1 MiB of complete lines are counted in parallel by worker processes.
+        packages = Counter()
+        # cores this process may run on, can be fewer than cores of the machine eg in a container
+        if hasattr(os, "sched_getaffinity"):
+            workers = len(os.sched_getaffinity(0))
+        else:
+            workers = os.cpu_count() or 1
         try:
-            # unzip file and store as list of lines
-            self.__file = gzip.open(temporary_file.name, "rt").readlines()
-        except:
-            print("[ERROR] unable to open the .gz file! ")
+            if workers == 1:
+                # a worker process would only add pickling of blocks and counts on a single core
+                for block in self.__read_blocks():
+                    packages.update(_count_packages(block))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    pending = deque()
+                    for block in self.__read_blocks():
+                        pending.append(pool.submit(_count_packages, block))
+
+                        # limit number of blocks waiting to be counted, to not keep whole file in memory
+                        while len(pending) >= 2*workers:
+                            packages.update(pending.popleft().result())
+
+                    while pending:
+                        packages.update(pending.popleft().result())
+        # network errors while streaming, or corrupt / truncated .gz file
+        except (OSError, EOFError, DecompressionError, urllib3.exceptions.HTTPError, requests.RequestException) as error:
+            print(f"[ERROR] unable to download or unzip the .gz file! ({error})")
 
             # I/O error
             exit(5)
 
+        # a worker process was killed or failed to start
+        except BrokenProcessPool as error:
+            print(f"[ERROR] a worker process counting packages stopped unexpectedly! ({error})")
+
+            # child process error
+            exit(10)
+
         finally:
             try:
-                temporary_file.close()
-            except:
+                self.__file.close()
+                self.__response.close()
+            except OSError:
                 pass
 
-    def __process_file(self):
-        """create a dict, key=package name ,value= no of files associated"""
-
-        # extract package names from a line in file and discard everything else
-        def clean_line(line):
-            if len(line.strip()) == 0:
-                return ["empty_line"]
+        # tranformation : {pack1:n1,pack2:n2...} => [pack1,pack2...] , [n1,n2...]
+        # package at index i of __names has __counts[i] files associated.
+        self.__names = list(packages)
+        self.__counts = array("q", packages.values())
 
-            # tranformation :   "filename    pack1,pack2" =>  ["pack1","pack2"]
-            return line.split(" ")[-1].strip().split(",")
+    def __load_cache(self):
+        """load version,package names and number of files associated of Contents file from previous run, if any."""
 
-        # tranformation : ["filename  pack1,pack2","filename pack3 pack4"....] => [["pack1","pack2"],["pack3","pack4"]...]
-        self.__file = list(map(clean_line, self.__file))
+        # one cache file per url, it is overwritten when the file on server changes
+        cache_key = hashlib.sha256(self.__file_url.encode()).hexdigest()
+        self.__cache_file = os.path.join(_CACHE_DIRECTORY, cache_key+".pkl")
 
-        # to save memory while transforming data : instead of copying,remove from one object and add to another.
+        try:
+            with open(self.__cache_file, "rb") as cache_file:
+                self.__cache = pickle.load(cache_file)
+        except Exception:
+            # missing or unreadable cache, the file is processed instead
+            self.__cache = None
 
-        temp_data = []
-        file_length = len(self.__file)
+    def __save_cache(self):
+        """store version,package names and number of files associated in cache, for next run."""
 
-        # transformation : [[pack1,pack2],[pack3,pack4]] => [pack1,pack2,pack3,pack4]
-        for i in range(file_length):
-            temp_data.extend(self.__file.pop())
+        # without a version there is no way to know if cache is stale on next run
+        if not self.__version:
+            return
 
-        # build a dict of packages and number of files associated.
-        self.__file = {}
-        temp_length = len(temp_data)
-        for j in range(temp_length):
-            package = temp_data.pop()
-            self.__file[package] = self.__file.get(package, 0)+1
+        try:
+            os.makedirs(_CACHE_DIRECTORY, exist_ok=True)
+
+            # write to a temporary file first, so a cache file is never left half written
+            temporary_file = self.__cache_file+f".{os.getpid()}.tmp"
+            with open(temporary_file, "wb") as cache_file:
+                pickle.dump((self.__version, self.__names,
+                            self.__counts), cache_file)
+            os.replace(temporary_file, self.__cache_file)
+        except OSError:
+            # output is still correct without cache
+            pass
 
     def __find_packages(self):
         """
@@ -156,32 +300,54 @@ class PackageStatistics:
          and store in self.__top_k_packages as list of list.
         """
 
-        self.__top_k_packages = []  # [[pack1,n1],.....,[packk,nk]]
-
-        # find package with maximum no of files associated  __top_k times
-        for i in range(self.__top_k):
-            max_file_count = 0
-            package_name = ""
-            for package, no_of_files in self.__file.items():
-                if no_of_files > max_file_count:
-                    package_name, max_file_count = package, no_of_files
+        # numpy is imported only for large k, where its O(n) partition pays for its import time.
+        numpy = None
+        if _NUMPY_TOP_K <= self.__top_k < len(self.__counts):
+            try:
+                import numpy
+            except ImportError:
+                pass
 
-            self.__top_k_packages.append([package_name, max_file_count])
+        # both ways order packages by number of files associated,then by id (first seen first),
+        # so output does not depend on numpy being installed.
+        if numpy is not None:
+            # find k-th largest count with a partition in O(n)
+            counts = numpy.frombuffer(self.__counts, dtype=numpy.int64)
+            kth_count = numpy.partition(counts, -self.__top_k)[-self.__top_k]
+
+            # all packages above it,and packages with lowest ids among those equal to it
+            above = numpy.flatnonzero(counts > kth_count)
+            ties = numpy.flatnonzero(counts == kth_count)[
+                :self.__top_k-len(above)]
+            top_k_ids = numpy.concatenate((above, ties))
+
+            # sort only those k
+            top_k_ids = top_k_ids[numpy.lexsort(
+                (top_k_ids, -counts[top_k_ids]))].tolist()
+        else:
+            # keep a heap of size __top_k while going over the counts once : O(n log k) instead of O(n*k)
+            top_k_ids = heapq.nlargest(
+                self.__top_k, range(len(self.__counts)), key=self.__counts.__getitem__)
 
-            # to not find same package again
-            self.__file[package_name] = 0
+        self.__top_k_packages = [[self.__names[i], self.__counts[i]]
+                                 for i in top_k_ids]  # [[pack1,n1],.....,[packk,nk]]
 
     def __print(self):
         """print top k packages with highest number of files associated"""
 
         # constant line length for each output line,to format output better.
-        LINE_LENGHT = 50
-        print()
-        for package in self.__top_k_packages:
-            package_name, number_of_files_associated = package[0], package[1]
-            print(package_name, " "*abs(LINE_LENGHT -
-                  len(package_name+str(number_of_files_associated))), number_of_files_associated)
-        print()
+        LINE_LENGTH = 50
+
+        # package names are kept as bytes while processing, decode only top k for output.
+        # debian package names are ascii,anything else in a malformed file is shown escaped instead of failing.
+        # counts are right aligned at LINE_LENGTH,names longer than that are followed by a single space.
+        lines = []
+        for name, count in self.__top_k_packages:
+            name = name.decode("ascii", errors="backslashreplace")
+            lines.append(f"{name} {count:>{max(LINE_LENGTH-len(name), 0)+1}}")
+
+        # build whole output first and write it at once,with an empty line before and after.
+        print("\n".join(["", *lines, ""]))
 
 
 if __name__ == "__main__":